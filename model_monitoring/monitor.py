@@ -15,34 +15,92 @@
 """Creates a Model Monitoring Job in Vertex AI for a deployed model endpoint."""
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import json
-import pprint as pp
-import subprocess
+import time
 import yaml
 
-from google.cloud import aiplatform
-from google.cloud.aiplatform import model_monitoring
-from google.cloud import logging
 from google.cloud import storage
+from google.cloud.storage.retry import DEFAULT_RETRY
 
-def execute_process(command: str, to_null: bool):
-    """Executes an external shell process.
+# The remaining google.cloud modules are imported where they are used to keep
+# startup cheap. storage stays at module scope so the upload worker thread never
+# performs a first-time SDK import while the main thread imports aiplatform.
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+_CLOUD_LOGS_SA = 'cloud-logs@system.gserviceaccount.com'
+_IAM_POLICY_MAX_ATTEMPTS = 5
+
+# (project_id, location) that aiplatform was last initialized with
+_aiplatform_initialized = (None, None)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_storage_client() -> storage.Client:
+    """Returns a process-wide storage client, created on first use."""
+    return storage.Client()
+
+
+@functools.lru_cache(maxsize=1)
+def _get_logging_client():
+    """Returns a process-wide logging client, created on first use."""
+    from google.cloud import logging
+    return logging.Client()
+
+
+@functools.lru_cache(maxsize=1)
+def _get_projects_client():
+    """Returns a process-wide resource manager projects client, created on first use."""
+    from google.cloud import resourcemanager_v3
+    return resourcemanager_v3.ProjectsClient()
+
+
+def add_project_iam_policy_binding(project_id: str, member: str, role: str):
+    """Grants a role on the project to the given member.
+
+    Equivalent to `gcloud projects add-iam-policy-binding`; the policy is
+    left untouched if the member already holds the role. Like gcloud, the
+    read-modify-write is retried if the policy changed concurrently.
 
     Args:
-        command: The string of the command to execute.
-        to_null: Determines where to send output.
+        project_id: The project ID.
+        member: The principal to grant the role to, e.g. serviceAccount:{email}.
+        role: The role to grant, e.g. roles/pubsub.publisher.
     Raises:
-        Exception: If an error occurs in executing the script.
+        Exception: If an error occurs reading or updating the IAM policy.
     """
-    stdout = subprocess.DEVNULL if to_null else None
-    try:
-        subprocess.run([command],
-                       shell=True,
-                       check=True,
-                       stdout=stdout,
-                       stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as err:
-        raise RuntimeError(f'Error executing process. {err}') from err
+    from google.api_core.exceptions import Aborted, GoogleAPICallError
+
+    projects_client = _get_projects_client()
+    resource = f'projects/{project_id}'
+    for attempt in range(_IAM_POLICY_MAX_ATTEMPTS):
+        try:
+            policy = projects_client.get_iam_policy(
+                request={'resource': resource, 'options': {'requested_policy_version': 3}})
+
+            for binding in policy.bindings:
+                if binding.role == role and not binding.HasField('condition'):
+                    if member in binding.members:
+                        return
+                    binding.members.append(member)
+                    break
+            else:
+                policy.bindings.add(role=role, members=[member])
+
+            projects_client.set_iam_policy(request={'resource': resource, 'policy': policy})
+            return
+        except Aborted as err:
+            # etag mismatch: the policy was modified since it was read
+            if attempt == _IAM_POLICY_MAX_ATTEMPTS - 1:
+                raise RuntimeError(f'Error updating IAM policy. {err}') from err
+            time.sleep(2 ** attempt)
+        except GoogleAPICallError as err:
+            raise RuntimeError(f'Error updating IAM policy. {err}') from err
 
 
 def write_file(filepath: str, text: str, mode: str):
@@ -58,7 +116,6 @@ def write_file(filepath: str, text: str, mode: str):
     try:
         with open(filepath, mode, encoding='utf-8') as file:
             file.write(text)
-        file.close()
     except OSError as err:
         raise OSError(f'Error writing to file. {err}') from err
 
@@ -76,17 +133,22 @@ def upload_automatic_retraining_parameters(
         gs_pipeline_job_spec_path: The GCS path of the pipeline job spec.
         storage_bucket_name: Name of the storage bucket to write to.
     """
-    auto_retraining_params['gs_pipeline_spec_path'] = gs_pipeline_job_spec_path
-    serialized_params = json.dumps(auto_retraining_params, indent=4)
+    params = {**auto_retraining_params, 'gs_pipeline_spec_path': gs_pipeline_job_spec_path}
     write_file('model_monitoring/automatic_retraining_parameters.json',
-               serialized_params, 'w')
+               json.dumps(params, indent=4), 'w')
+
+    # The uploaded copy is only read by the submission service, so keep it compact
+    serialized_params = json.dumps(params, separators=(',', ':'))
 
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(storage_bucket_name)
-    filename = '/'.join(gs_auto_retraining_params_path.split('/')[3:])
+    storage_client = _get_storage_client()
+    bucket = storage_client.bucket(storage_bucket_name)
+    filename = gs_auto_retraining_params_path.split('/', 3)[3]
     blob = bucket.blob(filename)
-    blob.upload_from_filename(
-        'model_monitoring/automatic_retraining_parameters.json')
+    # Overwriting the params with the same content is idempotent, so retry
+    # transient errors even though no generation precondition is set.
+    blob.upload_from_string(serialized_params,
+                            content_type='application/json',
+                            retry=DEFAULT_RETRY.with_deadline(30.0))
 
 
 def create_or_update_sink(sink_name: str,
@@ -105,21 +167,28 @@ def create_or_update_sink(sink_name: str,
         filter_: The log filter for sending logs.
                  Filters only monitoring job anomalies.
     """
-    logging_client = logging.Client()
+    from google.api_core.exceptions import NotFound
+
+    logging_client = _get_logging_client()
     sink = logging_client.sink(sink_name)
 
-    if sink.exists():
-        sink = logging_client.sink(sink_name,
-                                   filter_=filter_,
-                                   destination=destination)
-        sink.update()
-        print(f'Updated Anomaly Log Sink {sink.name}.\n')
-    else:
-        sink = logging_client.sink(sink_name,
-                                   filter_=filter_,
-                                   destination=destination)
+    try:
+        sink.reload()
+    except NotFound:
+        sink.filter_ = filter_
+        sink.destination = destination
         sink.create()
         print(f'Created Anomaly Log Sink {sink.name}.\n')
+        return
+
+    if sink.filter_ == filter_ and sink.destination == destination:
+        print(f'Anomaly Log Sink {sink.name} already up-to-date.\n')
+        return
+
+    sink.filter_ = filter_
+    sink.destination = destination
+    sink.update()
+    print(f'Updated Anomaly Log Sink {sink.name}.\n')
 
 
 def create_or_update_monitoring_job(
@@ -164,14 +233,20 @@ def create_or_update_monitoring_job(
         training_dataset: Training dataset used to train the deployed model. This field is required if
             using skew detection.
     """
-    aiplatform.init(project=project_id, location=monitoring_location)
+    from google.api_core.exceptions import NotFound
+    from google.cloud import aiplatform
+    from google.cloud.aiplatform import model_monitoring
 
-    # check if endpoint exists
-    endpoint_list = aiplatform.Endpoint.list(filter=f'endpoint="{model_endpoint.split("/")[-1]}"')
-    if not endpoint_list:
-        raise ValueError(f'Model endpoint {model_endpoint} not found in {monitoring_location}')
-    else:
+    global _aiplatform_initialized
+    if _aiplatform_initialized != (project_id, monitoring_location):
+        aiplatform.init(project=project_id, location=monitoring_location)
+        _aiplatform_initialized = (project_id, monitoring_location)
+
+    # check if endpoint exists; constructing the Endpoint issues a single get
+    try:
         endpoint = aiplatform.Endpoint(model_endpoint)
+    except NotFound as err:
+        raise ValueError(f'Model endpoint {model_endpoint} not found in {monitoring_location}') from err
 
     # Set skew and drift thresholds
     if skew_thresholds:
@@ -224,7 +299,7 @@ def create_or_update_monitoring_job(
     else:
         # Update the monitoring job.
         old_job_id = job_list[0].resource_name.split('/')[-1]
-        job = aiplatform.ModelDeploymentMonitoringJob(old_job_id).update(
+        job = job_list[0].update(
             display_name=job_display_name,
             logging_sampling_strategy=random_sampling,
             schedule_config=schedule_config,
@@ -236,13 +311,13 @@ def create_or_update_monitoring_job(
     if auto_retraining_params:
         # Filter to only send anomaly logs to pub/sub
         job_id = job.resource_name.split('/')[-1]
-        monitoring_anomaly_log_filter = (
-            f'resource.type="aiplatform.googleapis.com/ModelDeploymentMonitoringJob"\n'
-            f'resource.labels.location="{monitoring_location}"\n'
-            f'resource.labels.model_deployment_monitoring_job="{job_id}"\n'
-            f'logName="projects/{project_id}/logs/aiplatform.googleapis.com%2Fmodel_monitoring_anomaly"\n'
-            f'severity>=WARNING\n')
-        anomaly_log_destination = f'''pubsub.googleapis.com/projects/{project_id}/topics/{pubsub_topic_name}'''
+        monitoring_anomaly_log_filter = '\n'.join((
+            'resource.type="aiplatform.googleapis.com/ModelDeploymentMonitoringJob"',
+            f'resource.labels.location="{monitoring_location}"',
+            f'resource.labels.model_deployment_monitoring_job="{job_id}"',
+            f'logName="projects/{project_id}/logs/aiplatform.googleapis.com%2Fmodel_monitoring_anomaly"',
+            'severity>=WARNING'))
+        anomaly_log_destination = f'pubsub.googleapis.com/projects/{project_id}/topics/{pubsub_topic_name}'
         # Create a log sink to send logs to pub/sub
         create_or_update_sink(
             sink_name=log_sink_name,
@@ -251,17 +326,14 @@ def create_or_update_monitoring_job(
 
         print(f'All anomaly logs for this model monitoring job are being routed to pub/sub topic {pubsub_topic_name} for automatic retraining.')
         print(f'Retraining will use the following parameters located at {gs_auto_retraining_params_path}: \n')
-        pp.pprint(auto_retraining_params)
+        print(json.dumps(auto_retraining_params, indent=2, default=str))
 
         # Update service account to be able to publish to Pub/Sub
-        cloud_logs_sa = 'cloud-logs@system.gserviceaccount.com'
-        newline = '\n'
-        update_iam = (
-            f'''gcloud projects add-iam-policy-binding {project_id} \{newline}'''
-            f'''--member="serviceAccount:{cloud_logs_sa}" \{newline}'''
-            f'''--role="roles/pubsub.publisher"''')
-        print(f'\nUpdating {cloud_logs_sa} with roles/pubsub.publisher')
-        execute_process(update_iam, to_null=True)
+        print(f'\nUpdating {_CLOUD_LOGS_SA} with roles/pubsub.publisher')
+        add_project_iam_policy_binding(
+            project_id=project_id,
+            member=f'serviceAccount:{_CLOUD_LOGS_SA}',
+            role='roles/pubsub.publisher')
 
 
 if __name__ == '__main__':
@@ -270,29 +342,47 @@ if __name__ == '__main__':
                         help='The config file for setting monitoring values.')
     args = parser.parse_args()
 
-    with open(args.config, 'r', encoding='utf-8') as config_file:
-        config = yaml.load(config_file, Loader=yaml.FullLoader)
+    with open(args.config, 'rb') as config_file:
+        config = yaml.load(config_file, Loader=SafeLoader)
 
-    if config['monitoring']['auto_retraining_params']:
-        upload_automatic_retraining_parameters(
-            auto_retraining_params=config['monitoring']['auto_retraining_params'],
+    # The params as uploaded, so the monitoring job prints exactly what retraining uses
+    auto_retraining_params = config['monitoring']['auto_retraining_params']
+    if auto_retraining_params:
+        auto_retraining_params = {
+            **auto_retraining_params,
+            'gs_pipeline_spec_path': config['pipelines']['gs_pipeline_job_spec_path']}
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # The params file is only read once an anomaly fires, so the upload
+        # can overlap with the monitoring job RPCs.
+        upload_future = None
+        if auto_retraining_params:
+            # Build the client here so credential discovery, and the imports it
+            # triggers, happen on the main thread rather than in the worker.
+            _get_storage_client()
+            upload_future = executor.submit(
+                upload_automatic_retraining_parameters,
+                auto_retraining_params=auto_retraining_params,
+                gs_auto_retraining_params_path=config['monitoring']['gs_auto_retraining_params_path'],
+                gs_pipeline_job_spec_path=config['pipelines']['gs_pipeline_job_spec_path'],
+                storage_bucket_name=config['gcp']['storage_bucket_name'])
+
+        create_or_update_monitoring_job(
+            alert_emails=config['monitoring']['alert_emails'],
+            auto_retraining_params=auto_retraining_params,
+            drift_thresholds=config['monitoring']['drift_thresholds'],
             gs_auto_retraining_params_path=config['monitoring']['gs_auto_retraining_params_path'],
-            gs_pipeline_job_spec_path=config['pipelines']['gs_pipeline_job_spec_path'],
-            storage_bucket_name=config['gcp']['storage_bucket_name'])
-
-    create_or_update_monitoring_job(
-        alert_emails=config['monitoring']['alert_emails'],
-        auto_retraining_params=config['monitoring']['auto_retraining_params'],
-        drift_thresholds=config['monitoring']['drift_thresholds'],
-        gs_auto_retraining_params_path=config['monitoring']['gs_auto_retraining_params_path'],
-        job_display_name=config['monitoring']['job_display_name'],
-        log_sink_name=config['monitoring']['log_sink_name'],
-        model_endpoint=config['monitoring']['model_endpoint'],
-        monitoring_interval=config['monitoring']['monitoring_interval'],
-        monitoring_location=config['monitoring']['monitoring_location'],
-        project_id=config['gcp']['project_id'],
-        pubsub_topic_name=config['gcp']['pubsub_topic_name'],
-        sample_rate=config['monitoring']['sample_rate'],
-        skew_thresholds=config['monitoring']['skew_thresholds'],
-        target_field=config['monitoring']['target_field'],
-        training_dataset=config['monitoring']['training_dataset'])
+            job_display_name=config['monitoring']['job_display_name'],
+            log_sink_name=config['monitoring']['log_sink_name'],
+            model_endpoint=config['monitoring']['model_endpoint'],
+            monitoring_interval=config['monitoring']['monitoring_interval'],
+            monitoring_location=config['monitoring']['monitoring_location'],
+            project_id=config['gcp']['project_id'],
+            pubsub_topic_name=config['gcp']['pubsub_topic_name'],
+            sample_rate=config['monitoring']['sample_rate'],
+            skew_thresholds=config['monitoring']['skew_thresholds'],
+            target_field=config['monitoring']['target_field'],
+            training_dataset=config['monitoring']['training_dataset'])
+
+        if upload_future:
+            upload_future.result()